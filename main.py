@@ -1,6 +1,181 @@
+from array import array
+
 import mido
 
-def separate_harmony_by_original_track_rank(input_midi_path, output_midi_path):
+# 入力トラックのイベントの種類コード (同じ時間の中ではこの順に処理する)
+EVENT_TYPE_NOTE_OFF = 0
+EVENT_TYPE_NOTE_ON = 1
+EVENT_TYPE_OTHER = 2
+
+# mido のメッセージの種類 (文字列) から種類コードへの表。ここにないものは全部 EVENT_TYPE_OTHER
+# (ベロシティ0の note_on はノートオフ扱いなので、取り込むときに別でチェックする)
+EVENT_TYPE_CODES_BY_MSG_TYPE = {
+    'note_on': EVENT_TYPE_NOTE_ON,
+    'note_off': EVENT_TYPE_NOTE_OFF,
+}
+
+def _assign_output_tracks(abs_times, type_codes, pitches, next_global_output_track_idx, original_track_idx=0, verbose=False):
+    """
+    1つの入力トラックの整数の列 (絶対時間・種類コード・ノート番号) だけを見て、
+    各イベントをどのグローバル出力トラックに送るかを決める関数。
+    MIDIメッセージには一切さわらない (整数の出し入れだけ) ので、書き込みは呼び出し側でまとめてやる。
+
+    Args:
+        abs_times (list[int]): 各イベントの絶対時間 (単調増加してること)
+        type_codes (list[int]): 各イベントの種類コード (EVENT_TYPE_NOTE_OFF など)
+        pitches (list[int]): 各イベントのノート番号 (ノート以外のメッセージは-1)
+        next_global_output_track_idx (int): 次に割り当てる新しい出力トラックのグローバルインデックス
+        original_track_idx (int): 入力トラック番号 (表示用)
+        verbose (bool): Trueなら新しい出力トラックの割り当てを表示する
+
+    Returns:
+        tuple: (event_order, output_idx_per_event, retrigger_off_idx_per_event, next_global_output_track_idx)
+            event_order (list[int]): 出力トラックに書き込む順に並べたイベント番号 (捨てるイベントは入らない)
+            output_idx_per_event (array): 各イベントの送り先のグローバル出力トラックidx (捨てるイベントは-1)
+            retrigger_off_idx_per_event (array): リトリガーのとき、そのノートオンの直前に強制ノートオフを
+                入れるグローバル出力トラックidx (リトリガーじゃなければ-1)
+            next_global_output_track_idx (int): 割り当てが進んだあとの次のグローバルインデックス
+    """
+    num_events = len(abs_times)
+    event_order = []
+    output_idx_per_event = array('i', [-1]) * num_events
+    retrigger_off_idx_per_event = array('i', [-1]) * num_events
+
+    # この入力トラック内のランクと、割り当てられたグローバル出力トラック番号の対応表
+    # index: この入力トラック内の和音のランク (0が最高音), value: グローバル出力トラックidx
+    # ランクは0から1つずつしか増えないので、辞書じゃなくてリストで足りる
+    rank_to_global_output_idx = []
+    
+    # この入力トラック内でアクティブなノートのピッチと、それが送られたグローバル出力トラック番号の表
+    # index: ノートピッチ (0~127), value: グローバル出力トラックidx (鳴ってなければ-1)
+    # ピッチは128通りしかないので、辞書より固定長の配列で直接引いたほうが速い
+    active_notes_pitch_to_global_output_idx = array('i', [-1]) * 128
+    
+    # この入力トラックのノート以外のメッセージが送られるグローバル出力トラック番号
+    # （この入力トラックのランク0の音と同じところ。まだ決まってなければ-1）
+    global_output_idx_for_non_notes = -1
+
+    # 和音を音の高い順に並べるためのバケツ (MIDIのノート番号は0~127しかないので128個で足りる)
+    # index: ノートピッチ, value: そのピッチのノートオンのイベント番号のリスト (使ってなければNone)
+    # 和音ごとに作り直すのはもったいないので使い回す。使ったところは並べ終わったらNoneに戻す
+    note_on_buckets_by_pitch = [None] * 128
+
+    # --- まず、イベントを処理する順番に1列に並べる ---
+    # 同じ時間の中では「ノートオフ → ノートオン (音が高い順) → その他」の順。
+    # ノートオフは来たそばから並べちゃって、ノートオンはバケツ、その他は一旦よけとく。
+    # 次のイベントで絶対時間が変わるところで、バケツとその他を後ろにくっつける (ソートいらず！)
+    sorted_event_idxs = []
+    current_other_idxs = []
+    highest_pitch_in_chord = -1
+    lowest_pitch_in_chord = 128
+
+    for event_idx in range(num_events):
+        type_code = type_codes[event_idx]
+        if type_code == EVENT_TYPE_NOTE_OFF:
+            sorted_event_idxs.append(event_idx)
+        elif type_code == EVENT_TYPE_NOTE_ON:
+            pitch = pitches[event_idx]
+            if note_on_buckets_by_pitch[pitch] is None:
+                note_on_buckets_by_pitch[pitch] = [event_idx]
+            else:
+                note_on_buckets_by_pitch[pitch].append(event_idx) # 同じピッチが重なってたら来た順
+            if pitch > highest_pitch_in_chord:
+                highest_pitch_in_chord = pitch
+            if pitch < lowest_pitch_in_chord:
+                lowest_pitch_in_chord = pitch
+        else:
+            current_other_idxs.append(event_idx)
+
+        # 次のイベントも同じ時間なら、まだグループの途中
+        if event_idx + 1 < num_events and abs_times[event_idx + 1] == abs_times[event_idx]:
+            continue
+
+        # バケツを高い方から順に拾う (和音がなければ range は空っぽ)
+        for pitch in range(highest_pitch_in_chord, lowest_pitch_in_chord - 1, -1):
+            if note_on_buckets_by_pitch[pitch] is not None:
+                sorted_event_idxs.extend(note_on_buckets_by_pitch[pitch])
+                note_on_buckets_by_pitch[pitch] = None # 次の和音のために片付け
+        highest_pitch_in_chord = -1
+        lowest_pitch_in_chord = 128
+
+        if current_other_idxs:
+            sorted_event_idxs.extend(current_other_idxs)
+            current_other_idxs = []
+
+    # --- 並べた順に1回だけなめて、種類ごとに送り先を決める ---
+    # 同じ時間のノートオンは高い順に続けて来るので、時間が変わったらランクを0に戻すだけでいい
+    chord_abs_time = -1
+    rank_in_orig_track_chord = -1 # この入力トラックのこの和音内でのランク (0が最高音)
+
+    for event_idx in sorted_event_idxs:
+        type_code = type_codes[event_idx]
+
+        if type_code == EVENT_TYPE_NOTE_OFF:
+            # --- ノートオフ処理 (この入力トラック内でアクティブだった音を探す) ---
+            off_pitch = pitches[event_idx]
+            target_global_output_idx = active_notes_pitch_to_global_output_idx[off_pitch]
+            if target_global_output_idx != -1:
+                event_order.append(event_idx)
+                output_idx_per_event[event_idx] = target_global_output_idx
+                
+                active_notes_pitch_to_global_output_idx[off_pitch] = -1
+            # else:
+                # print(f"  入力trk {original_track_idx} 時刻 {abs_times[event_idx]}: ノートオフ {off_pitch} の対応ノートオンが見つからんかった…")
+
+        elif type_code == EVENT_TYPE_NOTE_ON:
+            # --- ノートオン処理 (この入力トラック内の和音をランク分け) ---
+            on_pitch = pitches[event_idx]
+            if abs_times[event_idx] != chord_abs_time:
+                chord_abs_time = abs_times[event_idx]
+                rank_in_orig_track_chord = 0
+            else:
+                rank_in_orig_track_chord += 1
+
+            # このランクの音が、この入力トラックで初めて出てきたかチェック
+            # (ランクは和音の中で0から順番に来るので、リストの長さと同じなら初登場)
+            if rank_in_orig_track_chord == len(rank_to_global_output_idx):
+                # 初めてなら、新しいグローバル出力トラック番号を割り当てる
+                rank_to_global_output_idx.append(next_global_output_track_idx)
+                
+                # もしこれがランク0の音で、まだこの入力トラックの非ノート用トラックが決まってなければ設定
+                if rank_in_orig_track_chord == 0 and global_output_idx_for_non_notes == -1:
+                    global_output_idx_for_non_notes = next_global_output_track_idx
+                
+                target_global_output_idx_for_this_note = next_global_output_track_idx
+                if verbose:
+                    print(f"  入力trk {original_track_idx} のランク {rank_in_orig_track_chord} の音に、新しい出力trk {target_global_output_idx_for_this_note} を割り当てたよ！")
+                next_global_output_track_idx += 1 # グローバルカウンターを進める
+            else:
+                # このランクの音は既に出てきてるので、前に割り当てたグローバル出力トラック番号を使う
+                target_global_output_idx_for_this_note = rank_to_global_output_idx[rank_in_orig_track_chord]
+
+            # リトリガー処理: 同じピッチの音がこの入力トラックで既にアクティブだったら、前の音をオフにする
+            # (アクティブな表はノートオフ処理で-1に戻るはずだけど、ここで戻しちゃうと、
+            #  同じ時間で同じピッチが別のランクで出てきた場合に困る。下で上書きするからOK)
+            retrigger_off_idx_per_event[event_idx] = active_notes_pitch_to_global_output_idx[on_pitch]
+
+            event_order.append(event_idx)
+            output_idx_per_event[event_idx] = target_global_output_idx_for_this_note
+            
+            # この入力トラックのアクティブなノート情報を更新
+            active_notes_pitch_to_global_output_idx[on_pitch] = target_global_output_idx_for_this_note
+
+        else:
+            # --- その他のメッセージ処理 (この入力トラックのランク0の音と同じ出力トラックへ) ---
+            if global_output_idx_for_non_notes == -1:
+                # この入力トラックでまだランク0の音が出てきてない (例: トラック先頭に非ノートメッセージ)
+                # なので、非ノートメッセージ用に新しいグローバル出力トラックを割り当てる
+                global_output_idx_for_non_notes = next_global_output_track_idx
+                if verbose:
+                    print(f"  入力trk {original_track_idx} のノート以外のメッセージ用に、新しい出力trk {global_output_idx_for_non_notes} を割り当てたよ！")
+                next_global_output_track_idx += 1
+            
+            event_order.append(event_idx)
+            output_idx_per_event[event_idx] = global_output_idx_for_non_notes
+
+    return event_order, output_idx_per_event, retrigger_off_idx_per_event, next_global_output_track_idx
+
+def separate_harmony_by_original_track_rank(input_midi_path, output_midi_path, verbose=False):
     """
     MIDIファイルの各入力トラック内の和音を検出し、その構成音を音高順のランク別に
     それぞれ新しい別の出力トラックに割り当てる関数。
@@ -14,6 +189,8 @@ def separate_harmony_by_original_track_rank(input_midi_path, output_midi_path):
     Args:
         input_midi_path (str): 入力MIDIファイルのパス
         output_midi_path (str): 出力MIDIファイルのパス
+        verbose (bool): Trueならトラックごとの処理状況やランクの割り当てを表示する。
+            1行ずつ表示するのは重いので、デフォルトはFalse
     """
     try:
         original_mid = mido.MidiFile(input_midi_path)
@@ -26,169 +203,101 @@ def separate_harmony_by_original_track_rank(input_midi_path, output_midi_path):
         return
 
     new_mid = mido.MidiFile(ticks_per_beat=original_mid.ticks_per_beat)
-    print(f"新しいMIDIファイル作る準備おっけー！ ticks_per_beat: {new_mid.ticks_per_beat}")
+    if verbose:
+        print(f"新しいMIDIファイル作る準備おっけー！ ticks_per_beat: {new_mid.ticks_per_beat}")
 
-    # --- ステップ1: 全ての新しい出力トラックのイベントを保存する辞書 ---
-    # key: 新しい出力トラックのグローバルインデックス (0から始まる通し番号)
-    # value: list of (絶対時間, MIDIメッセージ)
-    all_output_events_for_new_tracks = {}
+    # --- ステップ1: 新しい出力トラックと、それぞれに最後に書き込んだイベントの絶対時間 ---
+    # index: 新しい出力トラックのグローバルインデックス (0から始まる通し番号)
+    # 1つの出力トラックには1つの入力トラックのイベントしか来ないし、時間順に処理してくから
+    # イベントを溜めとかずに、その場でデルタタイムを計算して MidiTrack に直接書き込んじゃう。
+    # (リトリガーの強制ノートオフも、その時間の処理中に書き込むので順番は崩れない)
+    # 入力のメッセージはコピーするときにデルタタイムをつける
+    output_midi_tracks = []
+    last_abs_time_per_output_track = []
     
     # --- ステップ2: 次に割り当てる新しい出力トラックのグローバルインデックス ---
     next_global_output_track_idx_to_assign = 0
 
     # --- ステップ3: 各入力トラックを順番に処理 ---
     for original_track_idx, original_track_obj in enumerate(original_mid.tracks):
-        print(f"--- 入力トラック {original_track_idx} の処理を開始するよん！ ---")
-
-        # 3a. この入力トラック内のイベントを絶対時間と一緒にリスト化
-        events_with_abs_time_this_orig_track = []
-        current_abs_time_for_this_orig_track = 0
-        for msg in original_track_obj:
-            current_abs_time_for_this_orig_track += msg.time
-            events_with_abs_time_this_orig_track.append({'abs_time': current_abs_time_for_this_orig_track, 'msg': msg})
-        
-        # イベントを絶対時間でソート (重要！)
-        events_with_abs_time_this_orig_track.sort(key=lambda x: x['abs_time'])
-
-        # 3b. この入力トラック内の時間ごとのイベントグループ
-        events_grouped_by_time_this_orig_track = {}
-        for event_info in events_with_abs_time_this_orig_track:
-            abs_time = event_info['abs_time']
-            if abs_time not in events_grouped_by_time_this_orig_track:
-                events_grouped_by_time_this_orig_track[abs_time] = []
-            events_grouped_by_time_this_orig_track[abs_time].append(event_info['msg']) # メッセージだけ保存
-
-        # 3c. この入力トラック内のランクと、割り当てられたグローバル出力トラック番号のマップ
-        # key: この入力トラック内の和音のランク (0が最高音), value: グローバル出力トラックidx
-        rank_to_global_output_idx_map_this_orig_track = {}
-        
-        # 3d. この入力トラック内でアクティブなノートのピッチと、それが送られたグローバル出力トラック番号のマップ
-        # key: ノートピッチ, value: グローバル出力トラックidx
-        active_notes_pitch_to_global_output_idx_this_orig_track = {}
-        
-        # 3e. この入力トラックのノート以外のメッセージが送られるグローバル出力トラック番号
-        #    （この入力トラックのランク0の音と同じところ。まだ決まってなければ-1）
-        global_output_idx_for_non_notes_this_orig_track = -1
+        if verbose:
+            print(f"--- 入力トラック {original_track_idx} の処理を開始するよん！ ---")
 
-        # 3f. 時間順にイベントを処理
-        sorted_abs_times_this_orig_track = sorted(events_grouped_by_time_this_orig_track.keys())
+        # 3a. この入力トラックのメッセージを、絶対時間・種類コード・ノート番号の列にまとめて変換
+        # MIDIトラックはデルタタイム順に並んでるから、絶対時間は勝手に単調増加する (ソートいらない！)。
+        # 種類コードとノート番号もここで1回だけ調べとけば、あとは整数の比較だけで済む
+        msgs_this_orig_track = original_track_obj
+        abs_times_this_orig_track = []
+        type_codes_this_orig_track = []
+        pitches_this_orig_track = [] # ノート以外のメッセージは -1
+        abs_time = 0
+        for msg in msgs_this_orig_track:
+            abs_time += msg.time
+            abs_times_this_orig_track.append(abs_time)
+            # 文字列の比較は1回の辞書引きだけにして、あとは整数の種類コードで比べる
+            type_code = EVENT_TYPE_CODES_BY_MSG_TYPE.get(msg.type, EVENT_TYPE_OTHER)
+            if type_code == EVENT_TYPE_OTHER:
+                pitches_this_orig_track.append(-1)
+            else:
+                if type_code == EVENT_TYPE_NOTE_ON and msg.velocity == 0:
+                    type_code = EVENT_TYPE_NOTE_OFF
+                pitches_this_orig_track.append(msg.note)
+            type_codes_this_orig_track.append(type_code)
 
-        for abs_time in sorted_abs_times_this_orig_track:
-            messages_at_this_abs_time = events_grouped_by_time_this_orig_track[abs_time]
-            
-            current_note_ons_this_orig_track = []
-            current_note_offs_this_orig_track = []
-            current_other_msgs_this_orig_track = []
-
-            for msg in messages_at_this_abs_time:
-                if msg.type == 'note_on' and msg.velocity > 0:
-                    current_note_ons_this_orig_track.append(msg)
-                elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                    current_note_offs_this_orig_track.append(msg)
-                else:
-                    current_other_msgs_this_orig_track.append(msg)
+        # 3b. 整数の列だけで、各イベントの送り先の出力トラックを決める
+        (event_order_this_orig_track,
+         output_idx_per_event_this_orig_track,
+         retrigger_off_idx_per_event_this_orig_track,
+         next_global_output_track_idx_to_assign) = _assign_output_tracks(
+            abs_times_this_orig_track, type_codes_this_orig_track, pitches_this_orig_track,
+            next_global_output_track_idx_to_assign, original_track_idx, verbose)
 
-            # --- ノートオフ処理 (この入力トラック内でアクティブだった音を探す) ---
-            for off_msg in current_note_offs_this_orig_track:
-                if off_msg.note in active_notes_pitch_to_global_output_idx_this_orig_track:
-                    target_global_output_idx = active_notes_pitch_to_global_output_idx_this_orig_track[off_msg.note]
-                    
-                    if target_global_output_idx not in all_output_events_for_new_tracks:
-                        all_output_events_for_new_tracks[target_global_output_idx] = []
-                    all_output_events_for_new_tracks[target_global_output_idx].append((abs_time, off_msg.copy()))
-                    
-                    del active_notes_pitch_to_global_output_idx_this_orig_track[off_msg.note]
-                # else:
-                    # print(f"  入力trk {original_track_idx} 時刻 {abs_time}: ノートオフ {off_msg.note} の対応ノートオンが見つからんかった…")
+        # 新しく割り当てられたグローバル出力トラックの分だけ MidiTrack を用意
+        while len(output_midi_tracks) < next_global_output_track_idx_to_assign:
+            output_midi_tracks.append(mido.MidiTrack())
+            last_abs_time_per_output_track.append(0)
 
-            # --- ノートオン処理 (この入力トラック内の和音をランク分け) ---
-            if current_note_ons_this_orig_track:
-                # この時間・この入力トラック内のノートオンを音が高い順にソート
-                sorted_note_ons_in_chord = sorted(current_note_ons_this_orig_track, key=lambda m: m.note, reverse=True)
-                
-                for rank_in_orig_track_chord, note_on_msg in enumerate(sorted_note_ons_in_chord):
-                    # rank_in_orig_track_chord は、この入力トラックのこの和音内でのランク (0が最高音)
-                    
-                    target_global_output_idx_for_this_note = -1
-
-                    # このランクの音が、この入力トラックで初めて出てきたかチェック
-                    if rank_in_orig_track_chord not in rank_to_global_output_idx_map_this_orig_track:
-                        # 初めてなら、新しいグローバル出力トラック番号を割り当てる
-                        rank_to_global_output_idx_map_this_orig_track[rank_in_orig_track_chord] = next_global_output_track_idx_to_assign
-                        
-                        # もしこれがランク0の音で、まだこの入力トラックの非ノート用トラックが決まってなければ設定
-                        if rank_in_orig_track_chord == 0 and global_output_idx_for_non_notes_this_orig_track == -1:
-                            global_output_idx_for_non_notes_this_orig_track = next_global_output_track_idx_to_assign
-                        
-                        target_global_output_idx_for_this_note = next_global_output_track_idx_to_assign
-                        print(f"  入力trk {original_track_idx} のランク {rank_in_orig_track_chord} の音に、新しい出力trk {target_global_output_idx_for_this_note} を割り当てたよ！")
-                        next_global_output_track_idx_to_assign += 1 # グローバルカウンターを進める
-                    else:
-                        # このランクの音は既に出てきてるので、前に割り当てたグローバル出力トラック番号を使う
-                        target_global_output_idx_for_this_note = rank_to_global_output_idx_map_this_orig_track[rank_in_orig_track_chord]
-
-                    # リトリガー処理: 同じピッチの音がこの入力トラックで既にアクティブだったら、前の音をオフにする
-                    if note_on_msg.note in active_notes_pitch_to_global_output_idx_this_orig_track:
-                        previous_global_output_idx_for_this_pitch = active_notes_pitch_to_global_output_idx_this_orig_track[note_on_msg.note]
-                        # print(f"  入力trk {original_track_idx} 時刻 {abs_time}: ノート {note_on_msg.note} がリトリガーっぽい。出力trk {previous_global_output_idx_for_this_pitch} の前の音をオフにするね。")
-                        forced_off_msg = mido.Message('note_off', channel=note_on_msg.channel, note=note_on_msg.note, velocity=0)
-                        
-                        if previous_global_output_idx_for_this_pitch not in all_output_events_for_new_tracks:
-                             all_output_events_for_new_tracks[previous_global_output_idx_for_this_pitch] = []
-                        all_output_events_for_new_tracks[previous_global_output_idx_for_this_pitch].append((abs_time, forced_off_msg))
-                        # active_notes_pitch_to_global_output_idx_this_orig_track からはノートオフ処理で消えるはずだけど、
-                        # ここで消しちゃうと、同じ時間で同じピッチが別のランクで出てきた場合に困る。下で上書きするからOK。
-
-                    # ノートオンイベントを、決定したグローバル出力トラック用のリストに追加
-                    if target_global_output_idx_for_this_note not in all_output_events_for_new_tracks:
-                        all_output_events_for_new_tracks[target_global_output_idx_for_this_note] = []
-                    all_output_events_for_new_tracks[target_global_output_idx_for_this_note].append((abs_time, note_on_msg.copy()))
-                    
-                    # この入力トラックのアクティブなノート情報を更新
-                    active_notes_pitch_to_global_output_idx_this_orig_track[note_on_msg.note] = target_global_output_idx_for_this_note
-            
-            # --- その他のメッセージ処理 (この入力トラックのランク0の音と同じ出力トラックへ) ---
-            if current_other_msgs_this_orig_track:
-                if global_output_idx_for_non_notes_this_orig_track == -1:
-                    # この入力トラックでまだランク0の音が出てきてない (例: トラック先頭に非ノートメッセージ)
-                    # なので、非ノートメッセージ用に新しいグローバル出力トラックを割り当てる
-                    global_output_idx_for_non_notes_this_orig_track = next_global_output_track_idx_to_assign
-                    print(f"  入力trk {original_track_idx} のノート以外のメッセージ用に、新しい出力trk {global_output_idx_for_non_notes_this_orig_track} を割り当てたよ！")
-                    next_global_output_track_idx_to_assign += 1
-                
-                if global_output_idx_for_non_notes_this_orig_track not in all_output_events_for_new_tracks:
-                    all_output_events_for_new_tracks[global_output_idx_for_non_notes_this_orig_track] = []
-                for other_msg in current_other_msgs_this_orig_track:
-                    all_output_events_for_new_tracks[global_output_idx_for_non_notes_this_orig_track].append((abs_time, other_msg.copy()))
-        
-        print(f"--- 入力トラック {original_track_idx} の処理おーわりっ！ ---")
+        # 3c. 決まった順番・送り先で、メッセージを出力トラックに書き込む
+        for event_idx in event_order_this_orig_track:
+            target_global_output_idx = output_idx_per_event_this_orig_track[event_idx]
+            abs_time = abs_times_this_orig_track[event_idx]
+            msg = msgs_this_orig_track[event_idx]
+
+            # リトリガーなら、前の音が送られた出力トラックに強制ノートオフを先に入れる
+            # (新しいノートオンより必ず先に書くこと！前の音と同じ出力トラックに送られる場合、
+            #  同じ時間でオフ→オンの順になってないと、新しい音がすぐ止まっちゃう)
+            previous_global_output_idx_for_this_pitch = retrigger_off_idx_per_event_this_orig_track[event_idx]
+            if previous_global_output_idx_for_this_pitch != -1:
+                # print(f"  入力trk {original_track_idx} 時刻 {abs_time}: ノート {msg.note} がリトリガーっぽい。出力trk {previous_global_output_idx_for_this_pitch} の前の音をオフにするね。")
+                delta_time = abs_time - last_abs_time_per_output_track[previous_global_output_idx_for_this_pitch]
+                assert delta_time >= 0, "出力トラックのイベントが時間順になってない！"
+                forced_off_msg = mido.Message('note_off', channel=msg.channel, note=msg.note, velocity=0, time=delta_time)
+                output_midi_tracks[previous_global_output_idx_for_this_pitch].append(forced_off_msg)
+                last_abs_time_per_output_track[previous_global_output_idx_for_this_pitch] = abs_time
 
-    # --- ステップ4: 集めたイベントから新しいMIDIトラックを実際に作る ---
+            delta_time = abs_time - last_abs_time_per_output_track[target_global_output_idx]
+            assert delta_time >= 0, "出力トラックのイベントが時間順になってない！"
+            output_midi_tracks[target_global_output_idx].append(msg.copy(time=delta_time))
+            last_abs_time_per_output_track[target_global_output_idx] = abs_time
+
+        if verbose:
+            print(f"--- 入力トラック {original_track_idx} の処理おーわりっ！ ---")
+
+    # --- ステップ4: 書き込み終わった出力トラックを新しいMIDIファイルに並べる ---
     num_final_output_tracks = next_global_output_track_idx_to_assign # これが実際に使われたトラック数になるはず
     
-    print(f"最終的に {num_final_output_tracks} 個のトラックを作るよん！")
+    if verbose:
+        print(f"最終的に {num_final_output_tracks} 個のトラックを作るよん！")
 
-    for new_track_idx in range(num_final_output_tracks):
-        new_midi_track_obj = mido.MidiTrack()
+    for new_track_idx, new_midi_track_obj in enumerate(output_midi_tracks):
         new_mid.tracks.append(new_midi_track_obj)
         
-        events_for_this_new_track = all_output_events_for_new_tracks.get(new_track_idx, [])
-        
-        if not events_for_this_new_track:
-            print(f"出力トラック {new_track_idx} にはイベントなかったみたい。空っぽトラック作るね。")
-        else:
-            print(f"出力トラック {new_track_idx} のイベントを書き込み中... イベント数: {len(events_for_this_new_track)}")
-            
-            events_for_this_new_track.sort(key=lambda x: x[0]) # 絶対時間でソート
-            
-            last_abs_time_in_this_new_track = 0
-            for abs_time, msg_to_add in events_for_this_new_track:
-                delta_time = abs_time - last_abs_time_in_this_new_track
-                new_midi_track_obj.append(msg_to_add.copy(time=delta_time))
-                last_abs_time_in_this_new_track = abs_time
+        if verbose:
+            print(f"出力トラック {new_track_idx} のイベント数: {len(new_midi_track_obj)}")
         
         # 各トラックの最後に end_of_track メタメッセージを追加 (お約束！)
-        has_end_of_track = any(msg.type == 'end_of_track' for msg in new_midi_track_obj)
+        # end_of_track は決まりで必ず最後のメッセージなので、最後の1個だけ見れば十分
+        has_end_of_track = bool(new_midi_track_obj) and new_midi_track_obj[-1].type == 'end_of_track'
         if not has_end_of_track:
             time_for_eot = 0
             new_midi_track_obj.append(mido.MetaMessage('end_of_track', time=time_for_eot))
@@ -205,5 +314,5 @@ if __name__ == "__main__":
     my_input_midi_file = "unwelcome.mid"  # 入力するMIDIファイルの名前
     my_output_midi_file = "output_unwelcome_orig_track_ranked.mid" # 新しく作るMIDIファイルの名前（変えたよ！）
 
-    # 処理スタート！
+    # 処理スタート！ (途中経過を見たいときは verbose=True をつけてね)
     separate_harmony_by_original_track_rank(my_input_midi_file, my_output_midi_file)